@@ -13,23 +13,48 @@ publisher_dish_fixed_local_image.py
 ✅ 封面图改为本地生成，不再依赖AI模型
 """
 
+import io
 import os
+import base64
+import csv
 import json
 import time
 import random
 import logging
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
 from datetime import datetime
-import pandas as pd
-from typing import List, Optional
+from typing import Callable, Dict, List, Optional
 import re
+import hashlib
+import functools
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import orjson  # 可选依赖：更快的 JSON 编解码
+except ImportError:
+    orjson = None
+
+try:
+    import xxhash  # 可选依赖：更快的非加密哈希（封面文件名摘要）
+except ImportError:
+    xxhash = None
+
+from llm_cache import LLMCache, make_key
+from publish_queue import PublishQueue
+from rate_limit import LimitedRetry, RateLimiter
 
 # 新增 PIL 库导入，用于本地生成图片
 from PIL import Image, ImageDraw, ImageFont
 
 # ---------------- 配置区 ----------------
 CSV_PATH = "/root/kaoshi/dish_data.csv"
+PUBLISHED_LOG_PATH = "/root/kaoshi/dish_published.csv"  # 发布状态追加日志（菜品标题, 发布时间）
 MCP_API_URL = "http://localhost:18060/api/v1/publish"
+QWEN_CACHE_PATH = "/root/kaoshi/qwen_cache.sqlite3"  # Qwen 响应缓存
+QWEN_CACHE_TTL = 30 * 86400  # 缓存有效期（秒）
+PUBLISH_QUEUE_PATH = "/root/kaoshi/publish_queue_caipunoai.sqlite3"  # 已生成待发布素材队列（与 caipu.py 分开，素材结构不同）
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY")
 
 QWEN_TEXT_MODEL = "qwen-plus"
@@ -38,6 +63,12 @@ MAX_RETRIES = 3
 SLEEP_RANGE = (2, 5)
 TAGS_COUNT = 3
 MAX_TITLE_LENGTH = 20  # 中文字符为单位
+QWEN_WORKERS = 4  # 单条菜品内并发的 Qwen 请求数
+PREPARE_WORKERS = 3  # 同时准备素材的菜品数（控制 DashScope 并发）
+QWEN_BATCH_SIZE = 5  # 单次批量请求合并的菜品数
+QWEN_MAX_CONCURRENCY = 6  # 同时在途的 DashScope 请求上限
+QWEN_QPM = 120  # DashScope 每分钟请求数上限
+SIMILAR_TEXT_THRESHOLD = 0.92  # 相似菜品复用文案的相似度阈值
 
 # 本地图片配置
 DISH_IMAGE_DIR = "/root/xiaohongshu-mcp/images"
@@ -46,6 +77,14 @@ IMAGE_WIDTH = 1140
 IMAGE_HEIGHT = 1472
 BG_COLOR = (245, 243, 240) # 白色背景
 TEXT_COLOR = (24, 125, 62) # 黑色文字
+MCP_ACCEPTS_DATA_URI = False  # MCP 支持 data:image/png;base64 图片时开启，封面不落盘
+COVER_LAYOUT_VERSION = 2  # 封面排版/编码版本：修改字号计算、换行或保存参数时递增，旧封面不再复用
+# 封面调色板：索引 0 为背景色、255 为文字色，中间为抗锯齿过渡色
+COVER_PALETTE = [
+    round(bg + (fg - bg) * i / 255)
+    for i in range(256)
+    for bg, fg in zip(BG_COLOR, TEXT_COLOR)
+]
 
 # 日志配置
 logging.basicConfig(
@@ -59,9 +98,80 @@ formatter = logging.Formatter("%(asctime)s - %(message)s")
 console.setFormatter(formatter)
 logging.getLogger().addHandler(console)
 
+# HTTP 会话：复用 DashScope / MCP 的长连接，避免每次请求重新建连和 TLS 握手
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive"})
+# DashScope 限流：并发上限 + 每分钟请求数，主动排队而不是撞 429
+QWEN_LIMITER = RateLimiter(QWEN_MAX_CONCURRENCY, QWEN_QPM)
+
+# DashScope 网络层重试：429/5xx 指数退避并遵守 Retry-After，每次重试也从 QWEN_LIMITER 取令牌；
+# MCP 发布走 http://，保持默认不重试，避免重复发布
+RETRY = LimitedRetry(
+    total=MAX_RETRIES,
+    backoff_factor=1.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["POST"]),
+    limiter=QWEN_LIMITER,
+)
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=RETRY))
+
+# Qwen 请求线程池：单条菜品内相互独立的请求并发执行
+QWEN_POOL = ThreadPoolExecutor(max_workers=QWEN_WORKERS)
+
+# Qwen 响应缓存：相同 (model, prompt) 直接复用上次结果
+QWEN_CACHE = LLMCache(QWEN_CACHE_PATH, ttl=QWEN_CACHE_TTL)
+
+# 待发布素材队列：中断后重新运行时直接取回，不再重新生成
+PUBLISH_QUEUE = PublishQueue(PUBLISH_QUEUE_PATH)
+
 
 # ---------------- 工具函数 ----------------
 
+# 预编译正则，避免热路径中重复查找/解析
+# Markdown 符号与空白合并为一个字符类，一次扫描完成删除符号与压缩空白
+_MD_WS_RE = re.compile(r'[\s#\*\-\>_`]+')
+_WS_RE = re.compile(r'\s')
+# 句末标点与段落关键词合并为一个交替正则，按命中的分组分派替换
+_FORMAT_RE = re.compile(r'(?P<punct>[。！？])|(?P<kw>原料|材料|食材|配料|制作流程|做法|步骤|提示|总结)[:：]')
+_BLANK_RE = re.compile(r'\n{3,}')
+_FENCE_RE = re.compile(r'^```(?:json)?\s*|\s*```$')
+_FILENAME_RE = re.compile(r'[^\w\u4e00-\u9fa5]')
+
+
+def json_loads(data):
+    """解析 JSON，安装了 orjson 时优先使用"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    """序列化为 UTF-8 JSON 字节串，安装了 orjson 时优先使用"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _parse_json_reply(text: str):
+    """解析模型输出中的 JSON（先去掉 ``` 代码块标记），解析失败返回 None"""
+    try:
+        return json_loads(_FENCE_RE.sub('', text))
+    except ValueError:
+        return None
+
+
+def _is_title_tags_reply(text: str) -> bool:
+    """合并请求的输出是否为 {"title": 字符串, "tags": 列表}"""
+    result = _parse_json_reply(text)
+    return isinstance(result, dict) and isinstance(result.get("title"), str) and isinstance(result.get("tags"), list)
+
+
+def _is_batch_reply(text: str) -> bool:
+    """批量请求的输出是否为非空的对象数组"""
+    items = _parse_json_reply(text)
+    return isinstance(items, list) and bool(items) and all(isinstance(item, dict) for item in items)
+
+
 def truncate_title(title: str) -> str:
     """截断标题"""
     if not title:
@@ -84,30 +194,56 @@ def clean_markdown(text: str) -> str:
     """清理 Markdown 符号，防止 MCP 过滤"""
     if not text:
         return ""
-    text = re.sub(r'[#\*\-\>_`]+', '', text)
-    text = re.sub(r'\s+', ' ', text)
+    # 含空白的片段压缩为一个空格，纯符号片段直接删除
+    text = _MD_WS_RE.sub(lambda m: ' ' if _WS_RE.search(m.group()) else '', text)
     return text.strip()
 
 
+def _format_repl(m) -> str:
+    """_FORMAT_RE 的替换回调：按命中的分组返回对应的换行格式"""
+    if m.lastgroup == "punct":
+        return m.group() + '\n\n'
+    return f"\n\n【{m.group('kw')}】\n"
+
+
 def format_content(text: str) -> str:
     """美化菜谱文案换行格式"""
     if not text:
         return ""
     text = text.strip()
 
-    # 在句号、感叹号、问号后加两个换行
-    text = re.sub(r'([。！？])', r'\1\n\n', text)
-
-    # 在关键段落标题前增加换行
-    keywords = ["原料", "材料", "食材", "配料", "制作流程", "做法", "步骤", "提示", "总结"]
-    for kw in keywords:
-        text = re.sub(rf'({kw})[:：]', r'\n\n【\1】\n', text)
+    # 一次扫描：句号、感叹号、问号后加两个换行；关键段落标题前增加换行
+    text = _FORMAT_RE.sub(_format_repl, text)
 
     # 压缩多余的空行
-    text = re.sub(r'\n{3,}', '\n\n', text)
+    text = _BLANK_RE.sub('\n\n', text)
 
     return text.strip()
 
+@functools.lru_cache(maxsize=64)
+def _get_font(path: str, size: int) -> ImageFont.FreeTypeFont:
+    """按 (路径, 字号) 缓存字体对象，避免重复解析字体文件"""
+    return ImageFont.truetype(path, size)
+
+
+@functools.lru_cache(maxsize=8192)
+def _char_width(font: ImageFont.FreeTypeFont, char: str) -> float:
+    """缓存单个字符在指定字体下的宽度（字体对象已由 _get_font 缓存，可作为键）"""
+    return font.getlength(char)
+
+
+def _count_lines(widths, max_width) -> int:
+    """按字宽序列模拟 wrap_text_dish 的逐字换行，只返回行数"""
+    lines, current_width = 1, 0
+    for width in widths:
+        if current_width + width <= max_width:
+            current_width += width
+        else:
+            lines += 1
+            current_width = width
+    return lines
+
+
 # 新增：用于本地图片生成时的文本换行
 def wrap_text_dish(text, font, max_width, draw):
     """自定义文本换行函数，按宽度限制换行"""
@@ -122,7 +258,7 @@ def wrap_text_dish(text, font, max_width, draw):
         current_line = []
         current_width = 0
         for char in part:
-            char_width = draw.textlength(char, font=font)
+            char_width = _char_width(font, char)
             if current_width + char_width <= max_width:
                 current_line.append(char)
                 current_width += char_width
@@ -138,47 +274,110 @@ def wrap_text_dish(text, font, max_width, draw):
 # ---------------- Qwen 调用 (未修改部分) ----------------
 # ... (Qwen 请求相关函数保持不变) ...
 
-def qwen_request(prompt: str, model: str = QWEN_TEXT_MODEL, timeout: int = 60):
-    """通用 Qwen 请求函数"""
-    url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
-    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {DASHSCOPE_API_KEY}"}
-    payload = {"model": model, "input": {"messages": [{"role": "user", "content": prompt}]}}
+# 系统提示词：静态指令放在前面作为固定前缀（可命中服务端前缀缓存），
+# 每条菜品的可变数据只放在最后的 user 消息中
+SYS_TITLE = """你是一位商用菜品配方的营销专家，请基于用户提供的原始菜名生成一个适合小红书风格的菜谱标题。
+
+要求：
+1️⃣ 控制在20个中文字符以内；
+2️⃣ 不出现任何品牌、饭店、人物或地名；
+3️⃣ 语言自然、有吸引力，强调是菜品的商业配方；
+4️⃣ 不要使用引号或标点符号；
+5️⃣ 只输出标题。"""
+
+SYS_TEXT = """你是一位专业大厨，请根据用户提供的菜品信息生成一篇“小红书风格”的菜谱分享内容。
 
-    resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-    data = resp.json()
+写作要求：
+1️⃣ 一定要保留原料和制作流程，不省略；
+2️⃣ 强调“这是饭店配方”；
+3️⃣ 文风自然、有食欲，600字左右；
+4️⃣ 禁止出现真实饭店、人物或品牌；
+5️⃣ 禁止违规引导互动（例如收藏或留言可获取资料之类）；
+请只输出成文内容。"""
+
+SYS_TAGS = f"""请基于用户提供的菜名和特点，生成{TAGS_COUNT}个适合小红书的标签。
+要求：
+1) 反映菜系/口味/食材/商业效益；
+2) 每个标签2~8字；
+3) 严格以JSON数组输出，如 ["家常菜","川菜","下饭"]。"""
+
+SYS_TITLE_TAGS = f"""你是一位商用菜品配方的营销专家，请基于用户提供的信息生成适合小红书风格的菜谱标题和标签。
+
+要求：
+1️⃣ 标题控制在20个中文字符以内，不出现任何品牌、饭店、人物或地名，不使用引号或标点符号，强调是菜品的商业配方；
+2️⃣ 生成{TAGS_COUNT}个标签，反映菜系/口味/食材/商业效益，每个标签2~8字；
+3️⃣ 严格以JSON对象输出，如 {{"title": "标题", "tags": ["家常菜","川菜","下饭"]}}，不要输出其他内容。"""
+
+SYS_BATCH = f"""你是一位商用菜品配方的营销专家兼专业大厨，用户会以JSON数组提供多道菜品的信息（id、菜名、特点、原料、制作流程），请为每道菜分别生成小红书风格的标题、菜谱分享内容和标签。
+
+要求：
+1️⃣ 标题控制在20个中文字符以内，不出现任何品牌、饭店、人物或地名，不使用引号或标点符号，强调是菜品的商业配方；
+2️⃣ 内容一定要保留原料和制作流程，不省略，强调“这是饭店配方”，文风自然、有食欲，600字左右，禁止出现真实饭店、人物或品牌，禁止违规引导互动（例如收藏或留言可获取资料之类）；
+3️⃣ 每道菜生成{TAGS_COUNT}个标签，反映菜系/口味/食材/商业效益，每个标签2~8字；
+4️⃣ 严格以JSON数组输出，每道菜一个对象并保留原id，如 [{{"id": 1, "title": "标题", "content": "内容", "tags": ["家常菜","川菜","下饭"]}}]，不要输出其他内容。"""
+
+# 近似缓存命名空间：带上模型和文案提示词的摘要，提示词修改后旧文案不再复用，
+# 两个脚本的文案提示词不同，各自的文案也互不复用
+SIMILAR_TEXT_NAMESPACE = "text:" + make_key(QWEN_TEXT_MODEL, SYS_TEXT)
+
+
+def qwen_request(system_prompt: str, user_prompt: str, model: str = QWEN_TEXT_MODEL,
+                 timeout: int = 60, refresh: bool = False, validate: Optional[Callable[[str], bool]] = None):
+    """
+    通用 Qwen 请求函数（refresh=True 时跳过缓存读取，重新请求）
+    validate 给定时只缓存和复用校验通过的输出，格式错误的结果不会在有效期内反复命中
+    """
+    cache_prompt = f"{system_prompt}\0{user_prompt}"
+    if not refresh:
+        cached = QWEN_CACHE.get(model, cache_prompt)
+        if cached and (validate is None or validate(cached)):
+            return cached
 
-    # 改进后的解析，兼容不同返回结构
-    text = (
-        data.get("output", {}).get("text")
-        or data.get("output", {}).get("choices", [{}])[0].get("message", {}).get("content")
-        or data.get("output", {}).get("choices", [{}])[0]
-        .get("message", {}).get("content", [{}])[0].get("text")
-    )
+    url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+    headers = {"Content-Type": "application/json", "Authorization": f"Bearer {DASHSCOPE_API_KEY}"}
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    payload = {"model": model, "input": {"messages": messages}}
+    # 请求体只编码一次，网络层重试时直接复用
+    body = json_dumps(payload)
+
+    with QWEN_LIMITER:
+        resp = SESSION.post(url, headers=headers, data=body, timeout=timeout)
+    data = json_loads(resp.content)
+
+    # 兼容不同返回结构：output.text 或 output.choices[0].message.content
+    output = data.get("output") or {}
+    text = output.get("text")
+    if text is None:
+        try:
+            text = output["choices"][0]["message"]["content"]
+        except (KeyError, IndexError, TypeError):
+            text = None
 
+    # content 可能是 [{"text": ...}] 形式的分段列表
     if isinstance(text, list):
-        text = "\n".join([str(t) for t in text])
-    return text.strip() if text else None
+        text = "\n".join([t.get("text", "") if isinstance(t, dict) else str(t) for t in text])
+    text = text.strip() if text else None
+    if text and (validate is None or validate(text)):
+        QWEN_CACHE.set(model, cache_prompt, text)
+    return text
 
 
 def call_qwen_title(original_title: str, features: str) -> Optional[str]:
     """AI生成优化标题"""
-    prompt = f"""
-你是一位商用菜品配方的营销专家，请基于以下信息生成一个适合小红书风格的菜谱标题：
-【原始菜名】：{original_title}
-
-要求：
-1️⃣ 控制在20个中文字符以内；
-2️⃣ 不出现任何品牌、饭店、人物或地名；
-3️⃣ 语言自然、有吸引力，强调是菜品的商业配方；
-4️⃣ 不要使用引号或标点符号；
-5️⃣ 只输出标题。
-"""
+    user_prompt = f"【原始菜名】：{original_title}"
     for attempt in range(1, MAX_RETRIES + 1):
         try:
             logging.info(f"🎯 生成AI标题: {original_title} (尝试 {attempt})")
-            title = qwen_request(prompt)
+            title = qwen_request(SYS_TITLE, user_prompt)
             if title:
                 return truncate_title(title)
+        except requests.RequestException as e:
+            # 网络层已由 SESSION 按 Retry 策略重试过，不再重复请求
+            logging.warning(f"❌ 标题生成请求失败: {e}")
+            break
         except Exception as e:
             logging.warning(f"❌ 标题生成异常: {e}")
         time.sleep(2)
@@ -187,28 +386,25 @@ def call_qwen_title(original_title: str, features: str) -> Optional[str]:
 
 def call_qwen_text(dish_name: str, features: str, ingredients: str, process: str) -> Optional[str]:
     """生成小红书风格菜谱文案"""
-    prompt = f"""
-你是一位专业大厨，请根据以下信息生成一篇“小红书风格”的菜谱分享内容。
-
-【菜名】：{dish_name}
-【特点】：{features}
-【原料】：{ingredients}
-【制作流程】：{process}
+    user_prompt = f"【菜名】：{dish_name}\n【特点】：{features}\n【原料】：{ingredients}\n【制作流程】：{process}"
+    # 近似缓存：菜名前缀一致且输入高度相似时直接复用已有文案
+    similar_query = f"{dish_name}|{features}|{ingredients}"
+    cached = QWEN_CACHE.get_similar(SIMILAR_TEXT_NAMESPACE, dish_name[:3], similar_query, SIMILAR_TEXT_THRESHOLD)
+    if cached:
+        logging.info(f"♻️ 复用相似菜品文案: {dish_name}")
+        return cached
 
-写作要求：
-1️⃣ 一定要保留原料和制作流程，不省略；
-2️⃣ 强调“这是饭店配方”；
-3️⃣ 文风自然、有食欲，600字左右；
-4️⃣ 禁止出现真实饭店、人物或品牌；
-5️⃣ 禁止违规引导互动（例如收藏或留言可获取资料之类）；
-请只输出成文内容。
-"""
     for attempt in range(1, MAX_RETRIES + 1):
         try:
             logging.info(f"📝 生成文案: {dish_name} (尝试 {attempt})")
-            text = qwen_request(prompt)
+            text = qwen_request(SYS_TEXT, user_prompt)
             if text:
+                QWEN_CACHE.add_similar(SIMILAR_TEXT_NAMESPACE, dish_name[:3], similar_query, text)
                 return text
+        except requests.RequestException as e:
+            # 网络层已由 SESSION 按 Retry 策略重试过，不再重复请求
+            logging.warning(f"❌ 文案生成请求失败: {e}")
+            break
         except Exception as e:
             logging.warning(f"❌ 文案生成异常: {e}")
         time.sleep(2)
@@ -217,31 +413,101 @@ def call_qwen_text(dish_name: str, features: str, ingredients: str, process: str
 
 def call_qwen_tags(dish_name: str, features: str) -> List[str]:
     """生成标签"""
-    prompt = f"""
-基于菜名『{dish_name}』和特点『{features}』，生成{TAGS_COUNT}个适合小红书的标签。
-要求：
-1) 反映菜系/口味/食材/商业效益；
-2) 每个标签2~8字；
-3) 严格以JSON数组输出，如 ["家常菜","川菜","下饭"]。
-"""
+    user_prompt = f"【菜名】：{dish_name}\n【特点】：{features}"
     for attempt in range(1, MAX_RETRIES + 1):
         try:
             logging.info(f"🏷️ 生成标签: {dish_name} (尝试 {attempt})")
-            tags_str = qwen_request(prompt)
+            # 缓存中的结果若解析失败，重试时需要绕过缓存重新生成
+            tags_str = qwen_request(SYS_TAGS, user_prompt, refresh=attempt > 1)
             if tags_str and tags_str.startswith("["):
                 try:
-                    tags = json.loads(tags_str)
+                    tags = json_loads(tags_str)
                     tags_clean = [t.strip() for t in tags if isinstance(t, str) and t.strip()]
                     if tags_clean:
                         return tags_clean[:TAGS_COUNT]
                 except Exception:
                     pass
+        except requests.RequestException as e:
+            # 网络层已由 SESSION 按 Retry 策略重试过，不再重复请求
+            logging.warning(f"❌ 标签生成请求失败: {e}")
+            break
         except Exception as e:
             logging.warning(f"❌ 标签生成异常: {e}")
         time.sleep(1)
     return [f"{dish_name[:4]}家常", "美食推荐", "下饭菜"]
 
 
+def call_qwen_title_and_tags(original_title: str, features: str) -> Optional[tuple]:
+    """
+    一次请求同时生成标题和标签，省去一次往返
+    :return: (标题, 标签列表)；输出不是合法 JSON 时返回 None，由调用方回退到分别生成
+    """
+    user_prompt = f"【原始菜名】：{original_title}\n【特点】：{features}"
+    try:
+        logging.info(f"🎯 生成AI标题和标签: {original_title}")
+        # 只缓存结构正确的输出，避免坏结果让该菜品在有效期内一直走分别生成的回退
+        text = qwen_request(SYS_TITLE_TAGS, user_prompt, validate=_is_title_tags_reply)
+        if not text:
+            return None
+        result = json_loads(_FENCE_RE.sub('', text))
+        title = truncate_title(result["title"])
+        tags = [t.strip() for t in result["tags"] if isinstance(t, str) and t.strip()]
+        if title and tags:
+            return title, tags[:TAGS_COUNT]
+        logging.warning(f"⚠️ 标题/标签结果不完整: {text}")
+    except Exception as e:
+        logging.warning(f"❌ 标题/标签合并生成异常: {e}")
+    return None
+
+
+def call_qwen_batch(dishes: List[dict]) -> Dict[int, dict]:
+    """
+    一次请求为多道菜品同时生成标题、文案和标签，按 id 分发结果
+    :param dishes: [{"id": 1, "菜名": ..., "特点": ..., "原料": ..., "制作流程": ...}, ...]
+    :return: {id: {"title": ..., "content": ..., "tags": [...]}}；解析失败或缺失的菜品不在结果中，由调用方逐条回退
+    """
+    user_prompt = json_dumps(dishes).decode("utf-8")
+    names = "、".join(d["菜名"] for d in dishes)
+    try:
+        logging.info(f"📦 批量生成标题/文案/标签: {names}")
+        # 多篇长文案合在一个 JSON 里容易被截断，结构不对的输出不缓存，同一批次下次重新请求
+        text = qwen_request(SYS_BATCH, user_prompt, timeout=180, validate=_is_batch_reply)
+        if not text:
+            return {}
+        items = json_loads(_FENCE_RE.sub('', text))
+    except Exception as e:
+        logging.warning(f"❌ 批量生成异常: {e}")
+        return {}
+
+    # 只接受本批次发出的 id：模型把 id 重新从 1 编号时，结果会错配到其他批次的菜品上，
+    # 此时整批作废，由调用方逐条回退；重复出现的 id 无法判断对应哪道菜，一并丢弃
+    sent_ids = {d["id"] for d in dishes}
+    results, seen_ids = {}, set()
+    for item in items if isinstance(items, list) else []:
+        try:
+            dish_id = int(item["id"])
+        except (KeyError, TypeError, ValueError):
+            continue
+        if dish_id not in sent_ids:
+            logging.warning(f"⚠️ 批量结果 id 与请求不符（{dish_id}），整批回退逐条生成: {names}")
+            return {}
+        if dish_id in seen_ids:
+            results.pop(dish_id, None)
+            continue
+        seen_ids.add(dish_id)
+        try:
+            title = truncate_title(item["title"])
+            content = item["content"].strip()
+            tags = [t.strip() for t in item["tags"] if isinstance(t, str) and t.strip()]
+        except (KeyError, TypeError, AttributeError):
+            continue
+        if title and content and tags:
+            results[dish_id] = {"title": title, "content": content, "tags": tags[:TAGS_COUNT]}
+    if len(results) < len(dishes):
+        logging.warning(f"⚠️ 批量结果不完整: {len(results)}/{len(dishes)}")
+    return results
+
+
 # ---------------- 封面图 (核心修改) ----------------
 
 # 🚨 已删除原 call_qwen_image 函数 🚨
@@ -251,21 +517,33 @@ def create_dish_image(title: str, dish_name: str) -> Optional[str]:
     本地生成菜谱封面图（模仿小红书封面，突出菜名文字）
     :param title: 最终标题
     :param dish_name: 原始菜名
-    :return: 本地图片文件路径
+    :return: 本地图片文件路径；MCP_ACCEPTS_DATA_URI 开启时返回 data URI
     """
-    if not os.path.exists(DISH_IMAGE_DIR):
-        os.makedirs(DISH_IMAGE_DIR)
+    if not MCP_ACCEPTS_DATA_URI:
+        if not os.path.exists(DISH_IMAGE_DIR):
+            os.makedirs(DISH_IMAGE_DIR)
+
+        # 修正后的代码：先清理标题，再使用 f-string 拼接文件名
+        # 注意：这里的 'title' 已经是 final_title，用于生成文件名
+        cleaned_title = _FILENAME_RE.sub('', title)
+        # 文件名带上标题、版式参数与排版版本的摘要：同一标题重复生成时直接复用已有封面
+        cover_key = (f"{title}|{DISH_FONT_PATH}|{IMAGE_WIDTH}x{IMAGE_HEIGHT}|{BG_COLOR}|{TEXT_COLOR}"
+                     f"|v{COVER_LAYOUT_VERSION}")
+        if xxhash is not None:
+            digest = xxhash.xxh3_64_hexdigest(cover_key.encode("utf-8"))
+        else:
+            digest = hashlib.sha1(cover_key.encode("utf-8")).hexdigest()[:16]
+        output_filename = f"{cleaned_title}_{digest}.png"
 
-    # 修正后的代码：先清理标题，再使用 f-string 拼接文件名
-    # 注意：这里的 'title' 已经是 final_title，用于生成文件名
-    cleaned_title = re.sub(r'[^\w\u4e00-\u9fa5]', '', title)
-    output_filename = f"{cleaned_title}_{int(time.time())}.png"
-    
-    output_path = os.path.join(DISH_IMAGE_DIR, output_filename)
+        output_path = os.path.join(DISH_IMAGE_DIR, output_filename)
+        if os.path.exists(output_path):
+            logging.info(f"♻️ 复用已有封面图: {output_path}")
+            return output_path
 
     try:
-        # 1. 创建图片
-        image = Image.new('RGB', (IMAGE_WIDTH, IMAGE_HEIGHT), BG_COLOR)
+        # 1. 创建图片：单通道画布（1 字节/像素），文字灰度即抗锯齿覆盖度，
+        #    保存前挂上背景色→文字色的渐变调色板转为调色板图
+        image = Image.new('L', (IMAGE_WIDTH, IMAGE_HEIGHT), 0)
         draw = ImageDraw.Draw(image)
 
         # 2. 标题配置
@@ -279,24 +557,35 @@ def create_dish_image(title: str, dish_name: str) -> Optional[str]:
         
         # 尝试加载字体
         try:
-            font = ImageFont.truetype(font_path, font_size)
+            font = _get_font(font_path, font_size)
         except IOError:
             logging.error(f"❌ 字体文件未找到或无法加载: {font_path}")
             print(f"❌ 字体文件未找到或无法加载: {font_path}")
             return None
 
-        # 4. 文本换行
+        # 4. 调整字体大小以适应最多3行：字宽与字号近似成正比，
+        #    在参考字号下量一次总宽度即可直接算出字号，再按实际换行微调
+        max_lines = 3
+        min_size, ref_size = 40, 100
+        ref_font = _get_font(font_path, ref_size)
+        ref_widths = [_char_width(ref_font, char) for char in title]
+        best_size = int(ref_size * max_lines * available_width / (sum(ref_widths) or 1))
+        best_size = max(min_size, min(font_size, best_size))
+        # 按字符换行时每行末尾会留空，估算值偏大时逐步缩小；
+        # 候选字号下的字宽由参考字宽等比缩放得到，不再逐字号测量
+        while best_size > min_size and _count_lines(ref_widths, available_width * ref_size / best_size) > max_lines:
+            best_size -= 2
+        # 最终字号实测一次（字形取整可能让估算略有偏差）
+        while best_size > min_size and len(wrap_text_dish(title, _get_font(font_path, best_size), available_width, draw)) > max_lines:
+            best_size -= 2
+        best_size = max(min_size, best_size)
+
+        # 5. 文本换行
         # 绘制文本的宽度占图片宽度的 90%
+        font_size = best_size
+        font = _get_font(font_path, font_size)
         lines = wrap_text_dish(title, font, available_width, draw)
         
-        # 5. 调整字体大小以适应最多3行
-        max_lines = 3
-        
-        while len(lines) > max_lines and font_size > 40:
-             font_size -= 5
-             font = ImageFont.truetype(font_path, font_size)
-             lines = wrap_text_dish(title, font, available_width, draw)
-        
         # 6. 绘制文本
         total_text_height = sum([font.getbbox(line)[3] for line in lines])
         line_spacing = 30
@@ -312,14 +601,22 @@ def create_dish_image(title: str, dish_name: str) -> Optional[str]:
             line_x = (IMAGE_WIDTH - line_width) // 2
             
             # 绘制文字
-            draw.text((line_x, current_y), line, fill=TEXT_COLOR, font=font)
+            draw.text((line_x, current_y), line, fill=255, font=font)
             
             # 更新 Y 坐标
             line_height = font.getbbox("示")[3]
             current_y += line_height + line_spacing
 
-        # 7. 保存图片
-        image.save(output_path, quality=95)
+        # 7. 保存图片（调色板 PNG）；封面只是大块纯色+文字，低压缩级别已足够小，
+        #    optimize 的多轮尝试耗时约为 compress_level=1 的十倍以上
+        image.putpalette(COVER_PALETTE)
+        if MCP_ACCEPTS_DATA_URI:
+            # 直接在内存中编码为 data URI，省去写盘和 MCP 读盘
+            buf = io.BytesIO()
+            image.save(buf, "PNG", compress_level=1, optimize=False)
+            logging.info(f"✅ 封面图已生成（data URI，{buf.tell()} 字节）")
+            return "data:image/png;base64," + base64.b64encode(buf.getvalue()).decode("ascii")
+        image.save(output_path, "PNG", compress_level=1, optimize=False)
         logging.info(f"✅ 封面图已保存至: {output_path}")
         return output_path
 
@@ -330,26 +627,78 @@ def create_dish_image(title: str, dish_name: str) -> Optional[str]:
 # ---------------- CSV ----------------
 # ... (CSV 相关函数保持不变) ...
 
-def load_csv_data() -> pd.DataFrame:
-    df = pd.read_csv(CSV_PATH, encoding="utf-8")
-    if "已发布" not in df.columns:
-        df["已发布"] = "未发布"
-    if "发布时间" not in df.columns:
-        df["发布时间"] = ""
-    for col in ["菜品标题", "特点", "原料", "制作流程"]:
-        if col not in df.columns:
-            raise ValueError(f"CSV缺少字段: {col}")
-        df[col] = df[col].fillna("").astype(str)
-    return df
-
-
-def save_csv_data(df: pd.DataFrame):
-    df.to_csv(CSV_PATH, index=False, encoding="utf-8")
+def _read_published_log() -> dict:
+    """读取发布状态日志：{菜品标题: 发布时间}"""
+    if not os.path.exists(PUBLISHED_LOG_PATH):
+        return {}
+    with open(PUBLISHED_LOG_PATH, encoding="utf-8", newline="") as f:
+        return {row[0]: row[1] for row in csv.reader(f) if len(row) >= 2}
+
+
+def append_published_log(title: str, publish_time: str):
+    """追加一条发布记录，不改写 CSV"""
+    with open(PUBLISHED_LOG_PATH, "a", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerow([title, publish_time])
+
+
+def _iter_csv_rows():
+    """逐行流式读取 CSV（dict），补齐/校验必要字段，叠加发布状态日志中尚未合并的记录"""
+    published = _read_published_log()
+    with open(CSV_PATH, encoding="utf-8", newline="") as f:
+        reader = csv.DictReader(f, restval="")
+        columns = reader.fieldnames or []
+        for col in ["菜品标题", "特点", "原料", "制作流程"]:
+            if col not in columns:
+                raise ValueError(f"CSV缺少字段: {col}")
+        for row in reader:
+            if "已发布" not in columns:
+                row["已发布"] = "未发布"
+            if "发布时间" not in columns:
+                row["发布时间"] = ""
+            publish_time = published.get(row["菜品标题"])
+            if publish_time is not None:
+                row["已发布"] = "已发布"
+                row["发布时间"] = publish_time
+            yield row
+
+
+def load_csv_data(only_unpublished: bool = False) -> Dict[str, dict]:
+    """
+    流式加载 CSV
+    :param only_unpublished: 只保留未发布的行，内存占用取决于未发布行数而非总行数
+    :return: {菜品标题: 行}，发布后按标题 O(1) 更新状态
+    """
+    rows = {}
+    for row in _iter_csv_rows():
+        if only_unpublished and row["已发布"] != "未发布":
+            continue
+        rows[row["菜品标题"]] = row
+    return rows
+
+
+def merge_published_log():
+    """
+    把发布状态日志合并回 CSV，程序退出时调用一次
+    逐行流式改写，先写临时文件再原子替换，避免中途中断留下半截 CSV；
+    替换后才删除日志，中断时下次运行会重新合并
+    """
+    if not os.path.exists(PUBLISHED_LOG_PATH):
+        return
+    tmp_path = f"{CSV_PATH}.tmp"
+    with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+        writer = None
+        for row in _iter_csv_rows():
+            if writer is None:
+                writer = csv.DictWriter(f, fieldnames=list(row), lineterminator="\n")
+                writer.writeheader()
+            writer.writerow(row)
+    os.replace(tmp_path, CSV_PATH)
+    os.remove(PUBLISHED_LOG_PATH)
     logging.info("💾 数据已保存")
 
 
-def filter_unpublished(df: pd.DataFrame) -> pd.DataFrame:
-    return df[df["已发布"] == "未发布"].reset_index(drop=True)
+def filter_unpublished(rows: Dict[str, dict]):
+    return (row for row in rows.values() if row["已发布"] == "未发布")
 
 
 # ---------------- 发布 (修改了签名和内部逻辑以适应本地文件) ----------------
@@ -362,31 +711,39 @@ def publish_to_mcp(title: str, content: str, image_path: str, tags: List[str]) -
     
     注意：此方式要求 MCP 后端服务器能够访问这个本地路径 (例如：MCP 运行在同一台服务器
           上，并且有权限读取 /root/caipu/dish_images/ 目录)。
+          开启 MCP_ACCEPTS_DATA_URI 时 image_path 为 data URI，原样提交。
     
     :param title: 标题
     :param content: 正文内容
-    :param image_path: 本地图片文件的绝对路径
+    :param image_path: 本地图片文件的绝对路径或 data URI
     :param tags: 标签列表
     :return: 发布是否成功
     """
     
     # 🚨 移除所有关于占位 URL 的代码和警告 🚨
     # 核心修改：直接将本地文件绝对路径作为 images 数组的元素
+    is_data_uri = image_path.startswith("data:")
+    image = image_path if is_data_uri else os.path.abspath(image_path)
     payload = {
         "title": title.strip(), 
         "content": content.strip(), 
-        # 直接使用本地文件绝对路径
-        "images": [os.path.abspath(image_path)], 
+        # 直接使用本地文件绝对路径（或 data URI）
+        "images": [image], 
         "tags": tags
     }
     
     # 记录日志，确认提交的是绝对路径
-    logging.info(f"📤 尝试使用本地路径发布: {os.path.abspath(image_path)}")
+    if is_data_uri:
+        logging.info(f"📤 尝试使用 data URI 发布（{len(image_path)} 字符）")
+    else:
+        logging.info(f"📤 尝试使用本地路径发布: {image}")
     
     try:
         # 在发送请求时，由于内容字段可能包含中文，确保 payload 能够正确编码
-        resp = requests.post(MCP_API_URL, json=payload, timeout=120)
-        result = resp.json()
+        resp = SESSION.post(
+            MCP_API_URL, data=json_dumps(payload), headers={"Content-Type": "application/json"}, timeout=120
+        )
+        result = json_loads(resp.content)
         
         if result.get("success"):
             logging.info(f"✅ 发布成功: {title}")
@@ -406,17 +763,177 @@ def publish_to_mcp(title: str, content: str, image_path: str, tags: List[str]) -
     return False
 
 
+# ---------------- 素材准备 ----------------
+
+def prepare_dish(row: dict, label: str = "", generated: Optional[dict] = None) -> Optional[dict]:
+    """
+    生成单条菜品的发布素材（标题、文案、标签、封面）
+    :param row: 待发布菜品所在行
+    :param label: 进度标识，如 [1/5]
+    :param generated: 批量请求已生成的标题/文案/标签，有则只需补封面图
+    :return: 素材字典；文案或封面生成失败时返回 None
+    """
+    original_title = row["菜品标题"]
+    features = sanitize_field(row["特点"])
+    ingredients = sanitize_field(row["原料"])
+    process = sanitize_field(row["制作流程"])
+
+    if generated:
+        final_title, tags = generated["title"], generated["tags"]
+        print(f"\n🧾 {label} 已由批量请求生成标题、文案和标签")
+    else:
+        print(f"\n🧾 {label} 正在生成AI标题和标签...")
+        title_and_tags = call_qwen_title_and_tags(original_title, features)
+        if title_and_tags:
+            final_title, tags = title_and_tags
+        else:
+            # 合并请求失败时回退为分别生成标题和标签
+            ai_title = call_qwen_title(original_title, features)
+            final_title = ai_title or truncate_title(original_title)
+            tags = None
+    print(f"✅ 最终标题: {final_title}")
+
+    # 文案与标签只依赖标题，并发请求以重叠网络等待；本地封面图同时在线程池中渲染
+    # 核心修改：调用本地图片生成函数，返回的是本地路径
+    image_future = QWEN_POOL.submit(create_dish_image, final_title, original_title)
+    if generated:
+        print("🎨 生成封面图...")
+        content = generated["content"]
+    else:
+        print("📝 生成文案 / 🏷️ 生成标签 / 🎨 生成封面图...")
+        text_future = QWEN_POOL.submit(call_qwen_text, final_title, features, ingredients, process)
+        tags_future = QWEN_POOL.submit(call_qwen_tags, final_title, features) if tags is None else None
+        content = text_future.result()
+        if tags_future:
+            tags = tags_future.result()
+    image_path = image_future.result()
+    if not content:
+        print("❌ 文案生成失败，跳过")
+        return None
+
+    content = clean_markdown(content)
+    content = format_content(content)
+
+    tags = [f"#{t}" if not t.startswith("#") else t for t in tags]
+    print(f"✅ 标签: {tags}")
+
+    if not image_path:
+        print("❌ 图片生成失败，跳过")
+        return None
+
+    return {
+        "original_title": original_title,
+        "title": final_title,
+        "content": content,
+        "tags": tags,
+        "image_path": image_path,
+    }
+
+
+# ---------------- 分阶段发布 ----------------
+
+def stage1_prepare_all(to_prepare: List[dict]) -> List[dict]:
+    """
+    第一阶段：并发生成全部菜品的发布素材，每条生成完成后立即写入持久化队列
+    （按完成顺序入队，单条菜品异常只记录日志，不影响其他已生成素材入队）
+    标题、文案、标签按 QWEN_BATCH_SIZE 道菜合并为一次请求，批量结果缺失的菜品再逐条生成
+    :param to_prepare: 待生成素材的菜品
+    :return: 生成成功的素材列表（顺序与 to_prepare 一致）
+    """
+    total = len(to_prepare)
+    batches = [
+        [
+            {
+                "id": idx + 1,
+                "菜名": row["菜品标题"],
+                "特点": sanitize_field(row["特点"]),
+                "原料": sanitize_field(row["原料"]),
+                "制作流程": sanitize_field(row["制作流程"]),
+            }
+            for idx, row in enumerate(to_prepare[start:start + QWEN_BATCH_SIZE], start)
+        ]
+        for start in range(0, total, QWEN_BATCH_SIZE)
+    ]
+
+    prepared = {}
+    # 同时准备的菜品数受 PREPARE_WORKERS 限制，避免超出 DashScope QPS
+    with ThreadPoolExecutor(max_workers=PREPARE_WORKERS) as pool:
+        generated = {}
+        for result in pool.map(call_qwen_batch, batches):
+            generated.update(result)
+        futures = {
+            pool.submit(prepare_dish, row, f"[{idx+1}/{total}]", generated.get(idx + 1)): idx
+            for idx, row in enumerate(to_prepare)
+        }
+        for future in as_completed(futures):
+            idx = futures[future]
+            try:
+                dish = future.result()
+            except Exception as e:
+                logging.error(f"❌ 素材生成异常，跳过: {to_prepare[idx]['菜品标题']}: {e}")
+                continue
+            if dish:
+                PUBLISH_QUEUE.put(dish["original_title"], dish)
+                prepared[idx] = dish
+    return [prepared[idx] for idx in sorted(prepared)]
+
+
+def stage2_publish_schedule(rows: Dict[str, dict], prepared: List[dict], pace: bool = True):
+    """
+    第二阶段：按节奏逐条发布，两次发布之间只剩纯等待
+    :param rows: 未发布数据，发布成功后更新状态并追加到发布状态日志
+    :param prepared: 已生成的素材列表
+    :param pace: 是否在进程内等待发布间隔；由外部定时器调度时为 False
+    """
+    for idx, dish in enumerate(prepared):
+        final_title = dish["title"]
+        content = dish["content"]
+        tags = dish["tags"]
+        # 封面文件可能已被清理，缺失时按标题重新渲染（命中缓存时几乎无开销）
+        if not dish["image_path"].startswith("data:") and not os.path.exists(dish["image_path"]):
+            dish["image_path"] = create_dish_image(final_title, dish["original_title"])
+            if not dish["image_path"]:
+                print("❌ 图片生成失败，跳过")
+                PUBLISH_QUEUE.remove(dish["original_title"])
+                continue
+        print(f"\n🚀 [{idx+1}/{len(prepared)}] 标题: {final_title}")
+        # 调试信息只在 DEBUG 级别输出，%.200s 在日志真正输出时才截取文案
+        cover = dish["image_path"] if not dish["image_path"].startswith("data:") else "data URI"
+        logging.debug("发布调试信息：封面(本地): %s 标签: %s 文案前200字: %.200s", cover, tags, content)
+
+        print("🚀 正在发布...")
+        if publish_to_mcp(final_title, content, dish["image_path"], tags):
+            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            row = rows[dish["original_title"]]
+            row["已发布"] = "已发布"
+            row["发布时间"] = now
+            append_published_log(dish["original_title"], now)
+            print(f"✅ 已发布: {final_title}")
+        else:
+            print("❌ 发布失败，跳过")
+        PUBLISH_QUEUE.remove(dish["original_title"])
+
+        if pace and idx < len(prepared) - 1:
+            delay = random.randint(3600 + 300, 3600 + 900)
+            print(f"⏳ 下次发布将在 {delay//60} 分钟后...")
+            time.sleep(delay)
+
+
 # ---------------- 主流程 (核心修改) ----------------
 
-def main():
+def main(count: Optional[int] = None):
+    """
+    :param count: 非交互单次运行时的发布条数；为 None 时交互输入每日数量，并在进程内按间隔发布
+    """
     if not DASHSCOPE_API_KEY:
         print("❌ 未设置 DASHSCOPE_API_KEY 环境变量")
         # 由于还需要 Qwen 生成标题/文案/标签，所以 DASHSCOPE_API_KEY 仍是必需的
         return
 
-    df = load_csv_data()
-    unpublished_df = filter_unpublished(df)
-    if unpublished_df.empty:
+    # 只加载未发布的行，发布状态先追加到日志，退出时由 merge_published_log 合并回完整 CSV
+    rows = load_csv_data(only_unpublished=True)
+    unpublished = list(filter_unpublished(rows))
+    if not unpublished:
         print("✅ 没有未发布的数据。")
         return
 
@@ -425,65 +942,49 @@ def main():
         print(f"❌ 字体文件未找到: {DISH_FONT_PATH}。请检查配置和路径。")
         return
 
-    daily_quota = int(input("\n请输入每日发布数量（建议≤10）: "))
-    if daily_quota > len(unpublished_df):
-        daily_quota = len(unpublished_df)
-    to_publish = unpublished_df.sample(frac=1).reset_index(drop=True)
-
-    for idx in range(daily_quota):
-        row = to_publish.iloc[idx]
-        original_title = row["菜品标题"]
-        features = sanitize_field(row["特点"])
-        ingredients = sanitize_field(row["原料"])
-        process = sanitize_field(row["制作流程"])
-
-        print(f"\n🧾 [{idx+1}/{daily_quota}] 正在生成AI标题...")
-        ai_title = call_qwen_title(original_title, features)
-        final_title = ai_title or truncate_title(original_title)
-        print(f"✅ 最终标题: {final_title}")
-
-        print("📝 生成文案...")
-        content = call_qwen_text(final_title, features, ingredients, process)
-        if not content:
-            print("❌ 文案生成失败，跳过")
-            continue
-
-        content = clean_markdown(content)
-        content = format_content(content)
+    daily_quota = count if count is not None else int(input("\n请输入每日发布数量（建议≤10）: "))
+    if daily_quota > len(unpublished):
+        daily_quota = len(unpublished)
+    # 上次中断时已生成、且仍未发布的素材优先发布，不再重新生成
+    unpublished_titles = {row["菜品标题"] for row in unpublished}
+    pending = []
+    for dish in PUBLISH_QUEUE.items():
+        if dish["original_title"] in unpublished_titles:
+            pending.append(dish)
+        else:
+            PUBLISH_QUEUE.remove(dish["original_title"])
+    pending = pending[:daily_quota]
+    if pending:
+        print(f"♻️ 恢复上次已生成的素材 {len(pending)} 条")
 
-        print("🏷️ 生成标签...")
-        tags = call_qwen_tags(final_title, features)
-        tags = [f"#{t}" if not t.startswith("#") else t for t in tags]
-        print(f"✅ 标签: {tags}")
+    pending_titles = {dish["original_title"] for dish in pending}
+    remaining = [row for row in unpublished if row["菜品标题"] not in pending_titles]
+    to_prepare = random.sample(remaining, daily_quota - len(pending))
 
-        # 核心修改：调用本地图片生成函数，返回的是本地路径
-        print("🎨 生成封面图...")
-        image_path = create_dish_image(final_title, original_title)
-        if not image_path:
-            print("❌ 图片生成失败，跳过")
-            continue
-
-        print(f"\n🚀 发布调试信息：\n标题: {final_title}\n封面(本地): {image_path}\n标签: {tags}\n文案前200字:\n{content[:200]}")
+    try:
+        prepared = pending + stage1_prepare_all(to_prepare)
+        stage2_publish_schedule(rows, prepared, pace=count is None)
+    finally:
+        # 合并失败只记录日志（发布状态日志保留，下次运行重新合并），不掩盖上面的原始异常
+        try:
+            merge_published_log()
+        except Exception as e:
+            logging.error(f"❌ 合并发布状态日志失败: {e}")
 
-        print("🚀 正在发布...")
-        # 传递本地图片路径给发布函数
-        if publish_to_mcp(final_title, content, image_path, tags):
-            now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            # 使用原标题来定位 DataFrame 中的行
-            df.loc[df["菜品标题"] == original_title, "已发布"] = "已发布" 
-            df.loc[df["菜品标题"] == original_title, "发布时间"] = now
-            save_csv_data(df)
-            print(f"✅ 已发布: {final_title}")
-        else:
-            print("❌ 发布失败，跳过")
+    print("\n🎉 今日发布完成！" if count is None else "\n🎉 本次发布完成！")
 
-        if idx < daily_quota - 1:
-            delay = random.randint(3600 + 300, 3600 + 900)
-            print(f"⏳ 下次发布将在 {delay//60} 分钟后...")
-            time.sleep(delay)
 
-    print("\n🎉 今日发布完成！")
+def positive_int(value: str) -> int:
+    """argparse 参数类型：正整数"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"必须是正整数: {value}")
+    return number
 
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="生成并发布菜谱笔记到小红书 MCP（本地封面）")
+    parser.add_argument("--count", type=positive_int,
+                        help="非交互单次运行：发布 N 条后立即退出，发布间隔交给 systemd timer / cron 调度")
+    args = parser.parse_args()
+    main(args.count)
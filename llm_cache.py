@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+llm_cache.py
+
+Qwen 响应本地缓存（SQLite）
+以 (model, prompt) 的哈希作为键做精确匹配（安装了 xxhash 时用 xxh3-128，否则 SHA-256），
+重复运行或失败后重跑时，相同提示词直接命中缓存，不再请求接口。
+另提供近似匹配：按字符二元组余弦相似度查找内容几乎相同的历史输入。
+可设置有效期（ttl，秒），对精确与近似两种记录都生效，过期记录不再命中并在启动时清理。
+"""
+
+import os
+import re
+import math
+import time
+import hashlib
+import sqlite3
+import threading
+from collections import Counter
+from typing import Optional
+
+try:
+    import xxhash  # 可选依赖：更快的非加密哈希
+except ImportError:
+    xxhash = None
+
+
+def make_key(model: str, prompt: str) -> str:
+    """生成缓存键（两种哈希的键长度不同，切换后旧记录只是不再命中）"""
+    data = (model + "\0" + prompt).encode("utf-8")
+    if xxhash is not None:
+        return xxhash.xxh3_128_hexdigest(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+_WS_RE = re.compile(r'\s+')
+
+
+def _bigrams(text: str) -> Counter:
+    """字符二元组向量（忽略空白）"""
+    text = _WS_RE.sub('', text)
+    if len(text) < 2:
+        return Counter(text)
+    return Counter(text[i:i + 2] for i in range(len(text) - 1))
+
+
+def similarity(a: str, b: str) -> float:
+    """两段文本的二元组余弦相似度，范围 0~1"""
+    va, vb = _bigrams(a), _bigrams(b)
+    if not va or not vb:
+        return 0.0
+    dot = sum(count * vb[gram] for gram, count in va.items())
+    norm = math.sqrt(sum(c * c for c in va.values())) * math.sqrt(sum(c * c for c in vb.values()))
+    return dot / norm
+
+
+class LLMCache:
+    """线程安全的 SQLite 键值缓存"""
+
+    def __init__(self, path: str, ttl: Optional[int] = None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT, created_at REAL)"
+            )
+            # 兼容旧版本创建的缓存表（无 created_at 列，视为已过期）
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(llm_cache)")]
+            if "created_at" not in columns:
+                self._conn.execute("ALTER TABLE llm_cache ADD COLUMN created_at REAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS similar_cache "
+                "(namespace TEXT, prefix TEXT, query TEXT, value TEXT, created_at REAL)"
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(similar_cache)")]
+            if "created_at" not in columns:
+                self._conn.execute("ALTER TABLE similar_cache ADD COLUMN created_at REAL")
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS idx_similar_prefix ON similar_cache (namespace, prefix)"
+            )
+            if ttl:
+                for table in ("llm_cache", "similar_cache"):
+                    self._conn.execute(
+                        f"DELETE FROM {table} WHERE created_at IS NULL OR created_at < ?", (time.time() - ttl,)
+                    )
+
+    def get(self, model: str, prompt: str) -> Optional[str]:
+        """查询缓存，未命中或已过期返回 None"""
+        key = make_key(model, prompt)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+        if not row:
+            return None
+        value, created_at = row
+        if self.ttl and (created_at is None or created_at < time.time() - self.ttl):
+            return None
+        return value
+
+    def set(self, model: str, prompt: str, value: str):
+        """写入缓存（同键覆盖）"""
+        key = make_key(model, prompt)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at) VALUES (?, ?, ?)",
+                (key, value, time.time()),
+            )
+
+    def get_similar(self, namespace: str, prefix: str, query: str, threshold: float) -> Optional[str]:
+        """
+        近似查询：只在 prefix 相同且未过期的记录中比较，避免把不同菜品误判为相似
+        :return: 相似度最高且不低于 threshold 的缓存值，未命中返回 None
+        """
+        cutoff = time.time() - self.ttl if self.ttl else None
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT query, value FROM similar_cache WHERE namespace = ? AND prefix = ? "
+                "AND (? IS NULL OR created_at >= ?)",
+                (namespace, prefix, cutoff, cutoff),
+            ).fetchall()
+        best_score, best_value = 0.0, None
+        for cached_query, value in rows:
+            score = similarity(query, cached_query)
+            if score > best_score:
+                best_score, best_value = score, value
+        return best_value if best_score >= threshold else None
+
+    def add_similar(self, namespace: str, prefix: str, query: str, value: str):
+        """写入近似查询记录"""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO similar_cache (namespace, prefix, query, value, created_at) VALUES (?, ?, ?, ?, ?)",
+                (namespace, prefix, query, value, time.time()),
+            )
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+publish_queue.py
+
+待发布素材的持久化队列（SQLite）
+素材生成完成后入队，发布后出队；进程在发布间隔中被中断时，
+重新运行可直接取回已生成的标题/文案/标签/封面，无需重新调用模型。
+"""
+
+import os
+import json
+import sqlite3
+import threading
+from typing import List
+
+
+class PublishQueue:
+    """线程安全的待发布素材队列，按 key（原始菜名）去重"""
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS publish_queue "
+                "(key TEXT PRIMARY KEY, payload TEXT, created_at TEXT DEFAULT CURRENT_TIMESTAMP)"
+            )
+
+    def put(self, key: str, item: dict):
+        """入队（同 key 覆盖）"""
+        payload = json.dumps(item, ensure_ascii=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO publish_queue (key, payload) VALUES (?, ?)", (key, payload)
+            )
+
+    def items(self) -> List[dict]:
+        """按入队顺序返回全部素材"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT payload FROM publish_queue ORDER BY created_at, rowid"
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def remove(self, key: str):
+        """出队"""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM publish_queue WHERE key = ?", (key,))
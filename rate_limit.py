@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+rate_limit.py
+
+DashScope 请求限流（线程安全）
+并发数上限 + 令牌桶按每分钟请求数（QPM）匀速放行，
+多线程同时生成素材时主动排队，避免触发 429 后集中重试。
+配合 LimitedRetry 使用时，urllib3 网络层的每次重试也各取一个令牌，计入 QPM。
+"""
+
+import time
+import threading
+
+from urllib3.util.retry import Retry
+
+
+class RateLimiter:
+    """并发信号量 + 令牌桶，用法：with LIMITER: resp = SESSION.post(...)"""
+
+    def __init__(self, max_concurrency: int, per_minute: int):
+        self._sem = threading.BoundedSemaphore(max_concurrency)
+        self._rate = per_minute / 60.0  # 每秒补充的令牌数
+        self._capacity = float(max_concurrency)
+        self._tokens = self._capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _acquire_token(self):
+        """取一个令牌，桶空时等待到下一个令牌生成"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self._rate
+            time.sleep(wait)
+
+    def __enter__(self):
+        self._sem.acquire()
+        try:
+            self._acquire_token()
+        except BaseException:
+            self._sem.release()
+            raise
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._sem.release()
+        return False
+
+
+class LimitedRetry(Retry):
+    """每次重试前（退避等待之后）从限流器取一个令牌，429/5xx 集中重试时同样受 QPM 约束"""
+
+    def __init__(self, *args, limiter: RateLimiter = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    def new(self, **kw):
+        # urllib3 每次重试都会用 new() 生成新的 Retry 对象，这里把限流器带过去
+        retry = super().new(**kw)
+        retry.limiter = self.limiter
+        return retry
+
+    def sleep(self, response=None):
+        super().sleep(response)
+        if self.limiter is not None:
+            self.limiter._acquire_token()
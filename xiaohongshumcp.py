@@ -6,24 +6,40 @@ import json
 import time
 import random
 import logging
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
 import csv
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-import pandas as pd
 from typing import List, Dict, Optional
 
+try:
+    import orjson  # 可选依赖：更快的 JSON 编解码
+except ImportError:
+    orjson = None
+
+from llm_cache import LLMCache
+from rate_limit import LimitedRetry, RateLimiter
+
 # 配置区
 STATE_FILE = "publish_state.json"
 LOG_FILE = "publisher.log"
 MCP_API_URL = "http://localhost:18060/api/v1/publish"
 DASHSCOPE_API_KEY = os.getenv("DASHSCOPE_API_KEY")
 CSV_PATH = "/root/kaoshi/cleaned_jingshibang_resource.csv"
+PUBLISHED_LOG_PATH = "/root/kaoshi/jingshibang_published.csv"  # 发布状态追加日志（title, 发布时间）
+QWEN_CACHE_PATH = "/root/kaoshi/qwen_cache.sqlite3"  # Qwen 响应缓存
+QWEN_CACHE_TTL = 30 * 86400  # 缓存有效期（秒）
 
 QWEN_TEXT_MODEL = "qwen-plus"
 QWEN_IMAGE_MODEL = "qwen-image-plus"
 MAX_RETRIES = 3  # 调用最大重试次数
 SLEEP_RANGE = (2, 5)  # 接口调用间隔
 TAGS_COUNT = 3  # 生成标签数量
+QWEN_WORKERS = 3  # 单条资料内并发的 Qwen 请求数
+QWEN_MAX_CONCURRENCY = 4  # 同时在途的 DashScope 请求上限
+QWEN_QPM = 120  # DashScope 每分钟请求数上限
 
 # 年级分组配置
 GRADE_GROUPS = {
@@ -43,32 +59,87 @@ formatter = logging.Formatter("%(asctime)s - %(message)s")
 console.setFormatter(formatter)
 logging.getLogger().addHandler(console)
 
+# HTTP 会话：复用 DashScope / MCP 的长连接，避免每次请求重新建连和 TLS 握手
+SESSION = requests.Session()
+SESSION.headers.update({"Connection": "keep-alive"})
+# DashScope 限流：并发上限 + 每分钟请求数，主动排队而不是撞 429
+QWEN_LIMITER = RateLimiter(QWEN_MAX_CONCURRENCY, QWEN_QPM)
+
+# DashScope 网络层重试：429/5xx 指数退避并遵守 Retry-After，每次重试也从 QWEN_LIMITER 取令牌；
+# MCP 发布走 http://，保持默认不重试，避免重复发布
+RETRY = LimitedRetry(
+    total=MAX_RETRIES,
+    backoff_factor=1.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(["POST"]),
+    limiter=QWEN_LIMITER,
+)
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=16, max_retries=RETRY))
+
+# Qwen 请求线程池：文案、标签、封面图互不依赖，并发执行
+QWEN_POOL = ThreadPoolExecutor(max_workers=QWEN_WORKERS)
+
+# Qwen 响应缓存：相同 (model, prompt) 在有效期内直接复用上次结果
+QWEN_CACHE = LLMCache(QWEN_CACHE_PATH, ttl=QWEN_CACHE_TTL)
+
+
+def json_loads(data):
+    """解析 JSON，安装了 orjson 时优先使用"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj) -> bytes:
+    """序列化为 UTF-8 JSON 字节串，安装了 orjson 时优先使用"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def qwen_request(prompt: str, refresh: bool = False) -> str:
+    """通用 Qwen 文本请求（带缓存，refresh=True 时跳过缓存读取，重新请求）"""
+    if not refresh:
+        cached = QWEN_CACHE.get(QWEN_TEXT_MODEL, prompt)
+        if cached:
+            return cached
+
+    url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {DASHSCOPE_API_KEY}"
+    }
+    payload = {
+        "model": QWEN_TEXT_MODEL,
+        "input": {
+            "messages": [
+                {"role": "user", "content": prompt}
+            ]
+        }
+    }
+    with QWEN_LIMITER:
+        resp = SESSION.post(url, headers=headers, data=json_dumps(payload), timeout=60)
+    data = json_loads(resp.content)
+    text = (data.get("output", {}).get("text") or "").strip()
+    if text:
+        QWEN_CACHE.set(QWEN_TEXT_MODEL, prompt, text)
+    else:
+        logging.warning(f"⚠️ 文本生成空结果: {data}")
+    return text
+
 
 def call_qwen_text(title: str) -> Optional[str]:
     """调用Qwen生成文本内容"""
     for attempt in range(1, MAX_RETRIES + 1):
         try:
             logging.info(f"📝 生成文案: {title} (尝试 {attempt})")
-            url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {DASHSCOPE_API_KEY}"
-            }
-            payload = {
-                "model": QWEN_TEXT_MODEL,
-                "input": {
-                    "messages": [
-                        {"role": "user",
-                         "content": f"帮我写一篇小红书风格的笔记，我们要软性介绍{title}这个资料，要客观的角度说它好用，讲价值，吸引家长或学生的兴趣，不要杜撰任何非真实的信息（包括内容、反馈、评论）。要求简洁、有吸引力，带emotion，约120-200字，结尾带CTA（自然地引导用户互动关注/点赞/评论，不要违反小红书的规定）"}
-                    ]
-                }
-            }
-            resp = requests.post(url, headers=headers, json=payload, timeout=60)
-            data = resp.json()
-            text = data.get("output", {}).get("text")
+            text = qwen_request(f"帮我写一篇小红书风格的笔记，我们要软性介绍{title}这个资料，要客观的角度说它好用，讲价值，吸引家长或学生的兴趣，不要杜撰任何非真实的信息（包括内容、反馈、评论）。要求简洁、有吸引力，带emotion，约120-200字，结尾带CTA（自然地引导用户互动关注/点赞/评论，不要违反小红书的规定）")
             if text:
-                return text.strip()
-            logging.warning(f"⚠️ 文本生成空结果: {data}")
+                return text
+        except requests.RequestException as e:
+            # 网络层已由 SESSION 按 Retry 策略重试过，不再重复请求
+            logging.warning(f"❌ 文本生成请求失败: {e}")
+            break
         except Exception as e:
             logging.warning(f"❌ 文本生成异常: {e}")
         time.sleep(3)
@@ -80,38 +151,27 @@ def call_qwen_tags(title: str) -> List[str]:
     for attempt in range(1, MAX_RETRIES + 1):
         try:
             logging.info(f"🏷️ 生成标签: {title} (尝试 {attempt})")
-            url = "https://dashscope.aliyuncs.com/api/v1/services/aigc/text-generation/generation"
-            headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {DASHSCOPE_API_KEY}"
-            }
-            payload = {
-                "model": QWEN_TEXT_MODEL,
-                "input": {
-                    "messages": [
-                        {"role": "user",
-                         "content": f"""基于标题『{title}』生成适用于小红书的标签，需满足：
+            # 缓存中的结果若格式不符，重试时需要绕过缓存重新生成
+            tags_str = qwen_request(f"""基于标题『{title}』生成适用于小红书的标签，需满足：
 1. 标签与资料内容强相关，强调地域和真题，吸引家长和学生
 2. 共生成{TAGS_COUNT}个，每个标签2-8字
 3. 不使用特殊符号，纯文字
 4. 格式必须为JSON数组（例如：["标签1", "标签2", "标签3"]）
-5. 标签间不重复，无空值"""}
-                    ]
-                }
-            }
-            resp = requests.post(url, headers=headers, json=payload, timeout=60)
-            data = resp.json()
-            tags_str = data.get("output", {}).get("text", "").strip()
+5. 标签间不重复，无空值""", refresh=attempt > 1)
             
             # 严格验证JSON格式
             if tags_str.startswith("[") and tags_str.endswith("]"):
-                tags = json.loads(tags_str)
+                tags = json_loads(tags_str)
                 # 二次清洗确保符合MCP要求
                 tags_clean = [str(t).strip() for t in tags if isinstance(t, str) and str(t).strip()]
                 if len(tags_clean) >= 1:
                     return tags_clean[:TAGS_COUNT]  # 确保不超过指定数量
             
             logging.warning(f"⚠️ 标签格式不符合要求: {tags_str}")
+        except requests.RequestException as e:
+            # 网络层已由 SESSION 按 Retry 策略重试过，不再重复请求
+            logging.warning(f"❌ 标签生成请求失败: {e}")
+            break
         except Exception as e:
             logging.warning(f"❌ 标签生成异常: {e}")
         time.sleep(3)
@@ -143,11 +203,16 @@ def call_qwen_image(title: str) -> Optional[str]:
                     "size": "1140*1472"
                 }
             }
-            resp = requests.post(url, headers=headers, json=payload, timeout=120)
-            data = resp.json()
+            with QWEN_LIMITER:
+                resp = SESSION.post(url, headers=headers, data=json_dumps(payload), timeout=120)
+            data = json_loads(resp.content)
             image_url = data["output"]["choices"][0]["message"]["content"][0]["image"]
             if image_url:
                 return image_url
+        except requests.RequestException as e:
+            # 网络层已由 SESSION 按 Retry 策略重试过，不再重复请求
+            logging.warning(f"❌ 图片生成请求失败: {e}")
+            break
         except Exception as e:
             logging.warning(f"❌ 图片生成异常: {e}")
         time.sleep(5)
@@ -167,11 +232,21 @@ def publish_to_mcp(title: str, content: str, image_url: str, tags: List[str]) ->
         "tags": tags  # 直接使用生成的清洗后标签
     }
 
+    # 请求体只编码一次；完整请求体只在 DEBUG 级别输出，INFO 级别只记录摘要
+    body = json_dumps(payload)
+    logging.info("🚀 发布内容: title=%s tags=%s image=%s", title, tags, image_url)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug("🚀 发布请求体: %s", body.decode("utf-8"))
+
     try:
-        logging.info(f"🚀 发布内容: {json.dumps(payload, ensure_ascii=False)}")
-        resp = requests.post(MCP_API_URL, json=payload, timeout=30)
+        resp = SESSION.post(
+            MCP_API_URL,
+            data=body,
+            headers={"Content-Type": "application/json"},
+            timeout=30,
+        )
         resp.raise_for_status()
-        result = resp.json()
+        result = json_loads(resp.content)
         if result.get("success"):
             logging.info(f"✅ 发布成功: {result['message']}")
             return True
@@ -181,61 +256,100 @@ def publish_to_mcp(title: str, content: str, image_url: str, tags: List[str]) ->
     return False
 
 
-def load_csv_data() -> pd.DataFrame:
+def _read_published_log() -> Dict[str, str]:
+    """读取发布状态日志：{title: 发布时间}"""
+    if not os.path.exists(PUBLISHED_LOG_PATH):
+        return {}
+    with open(PUBLISHED_LOG_PATH, encoding="utf-8", newline="") as f:
+        return {row[0]: row[1] for row in csv.reader(f) if len(row) >= 2}
+
+
+def append_published_log(title: str, publish_time: str):
+    """追加一条发布记录，不改写 CSV"""
+    with open(PUBLISHED_LOG_PATH, "a", encoding="utf-8", newline="") as f:
+        csv.writer(f).writerow([title, publish_time])
+
+
+def load_csv_data() -> List[Dict[str, str]]:
     """加载CSV数据并确保必要的列存在"""
     try:
-        # 读取CSV文件，确保编码为utf-8
-        df = pd.read_csv(CSV_PATH, encoding="utf-8")
-        
-        # 检查并添加必要的列
-        if "已发布" not in df.columns:
-            df["已发布"] = "未发布"
-        if "发布时间" not in df.columns:
-            df["发布时间"] = ""
+        # 读取CSV文件，确保编码为utf-8；每行为 {列名: 字符串}，缺失的单元格读成 ""
+        with open(CSV_PATH, encoding="utf-8", newline="") as f:
+            reader = csv.DictReader(f, restval="")
+            columns = reader.fieldnames or []
+            rows = list(reader)
             
         # 确保年级列存在
-        if "年级" not in df.columns:
+        if "年级" not in columns:
             logging.error("❌ CSV文件中未找到'年级'列")
             raise ValueError("CSV文件缺少'年级'列")
             
         # 确保标题列存在
-        if "title" not in df.columns:
+        if "title" not in columns:
             logging.error("❌ CSV文件中未找到'title'列")
             raise ValueError("CSV文件缺少'title'列")
+
+        # 检查并添加必要的列，同时叠加发布状态日志中尚未合并的记录
+        published = _read_published_log()
+        for row in rows:
+            if "已发布" not in columns:
+                row["已发布"] = "未发布"
+            if "发布时间" not in columns:
+                row["发布时间"] = ""
+            publish_time = published.get(row["title"])
+            if publish_time is not None:
+                row["已发布"] = "已发布"
+                row["发布时间"] = publish_time
             
-        return df
+        return rows
     except Exception as e:
         logging.error(f"❌ 加载CSV数据失败: {e}")
         raise
 
 
-def save_csv_data(df: pd.DataFrame):
-    """保存数据到CSV文件"""
+def save_csv_data(rows: List[Dict[str, str]]):
+    """保存数据到CSV文件：先写临时文件再原子替换，避免中途中断留下半截 CSV"""
+    if not rows:
+        return
+    tmp_path = f"{CSV_PATH}.tmp"
     try:
-        df.to_csv(CSV_PATH, index=False, encoding="utf-8")
+        with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]), lineterminator="\n")
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, CSV_PATH)
         logging.info("💾 数据已成功保存到CSV文件")
     except Exception as e:
         logging.error(f"❌ 保存CSV数据失败: {e}")
         raise
 
 
-def get_available_grades(df: pd.DataFrame) -> List[str]:
+def merge_published_log(rows: Optional[List[Dict[str, str]]] = None):
+    """
+    把发布状态日志合并回 CSV，程序退出时调用一次；保存成功后才删除日志
+    :param rows: 已加载并叠加了发布状态的数据；为 None 时重新加载
+    """
+    if not os.path.exists(PUBLISHED_LOG_PATH):
+        return
+    save_csv_data(rows if rows is not None else load_csv_data())
+    os.remove(PUBLISHED_LOG_PATH)
+
+
+def get_available_grades(rows: List[Dict[str, str]]) -> List[str]:
     """获取CSV中所有可用的年级"""
-    return sorted(df["年级"].dropna().unique().tolist())
+    return sorted({row["年级"] for row in rows if row["年级"]})
 
 
-def filter_by_grade(df: pd.DataFrame, grade_choice: str) -> pd.DataFrame:
+def filter_by_grade(rows: List[Dict[str, str]], grade_choice: str) -> List[Dict[str, str]]:
     """根据年级选择筛选数据"""
-    # 筛选未发布的数据
-    unpublished = df[df["已发布"] == "未发布"]
-    
     if grade_choice in GRADE_GROUPS:
         # 按分组筛选
-        target_grades = GRADE_GROUPS[grade_choice]
-        return unpublished[unpublished["年级"].isin(target_grades)]
+        target_grades = set(GRADE_GROUPS[grade_choice])
     else:
         # 按具体年级筛选
-        return unpublished[unpublished["年级"] == grade_choice]
+        target_grades = {grade_choice}
+    # 筛选未发布的数据
+    return [row for row in rows if row["已发布"] == "未发布" and row["年级"] in target_grades]
 
 
 def show_progress(current: int, total: int, daily_quota: int):
@@ -245,70 +359,87 @@ def show_progress(current: int, total: int, daily_quota: int):
     print(f"⏳ 剩余待发布: {max(0, daily_quota - current)}条")
 
 
-def main():
+def main(grade: Optional[str] = None, count: Optional[int] = None):
+    """
+    :param grade: 非交互运行时的发布范围（高中组/初中组/具体年级）；为 None 时交互选择
+    :param count: 非交互单次运行时的发布条数；给定时发布完立即退出，不在进程内等待发布间隔
+    """
     if not DASHSCOPE_API_KEY:
         logging.error("❌ 未设置DASHSCOPE_API_KEY环境变量")
         print("❌ 错误: 请先设置DASHSCOPE_API_KEY环境变量")
         return
 
+    rows = None
     try:
         # 加载CSV数据
         print("📂 正在加载数据...")
-        df = load_csv_data()
-        print(f"✅ 成功加载数据，共{len(df)}条记录，其中未发布{len(df[df['已发布'] == '未发布'])}条")
+        rows = load_csv_data()
+        unpublished_count = sum(1 for row in rows if row["已发布"] == "未发布")
+        print(f"✅ 成功加载数据，共{len(rows)}条记录，其中未发布{unpublished_count}条")
 
         # 显示年级筛选选项
-        available_grades = get_available_grades(df)
-        print("\n📋 请选择发布范围:")
-        print("0: 高中组 (高一、高二、高三、高中、高考)")
-        print("1: 初中组 (初一、初二、初三、中考真)")
+        available_grades = get_available_grades(rows)
+        if grade:
+            if grade not in GRADE_GROUPS and grade not in available_grades:
+                print(f"❌ 无效的发布范围: {grade}")
+                return
+            selected_grade = grade
+        else:
+            print("\n📋 请选择发布范围:")
+            print("0: 高中组 (高一、高二、高三、高中、高考)")
+            print("1: 初中组 (初一、初二、初三、中考真)")
         
-        for i, grade in enumerate(available_grades, 2):
-            print(f"{i}: 具体年级 - {grade}")
-
-        # 获取用户选择
-        while True:
-            try:
-                choice = int(input("\n请输入选项编号: "))
-                if choice == 0:
-                    selected_grade = "高中组"
-                    break
-                elif choice == 1:
-                    selected_grade = "初中组"
-                    break
-                elif 2 <= choice < 2 + len(available_grades):
-                    selected_grade = available_grades[choice - 2]
-                    break
-                else:
-                    print("❌ 无效选项，请重新输入")
-            except ValueError:
-                print("❌ 请输入有效的数字")
+            for i, name in enumerate(available_grades, 2):
+                print(f"{i}: 具体年级 - {name}")
+
+            # 获取用户选择
+            while True:
+                try:
+                    choice = int(input("\n请输入选项编号: "))
+                    if choice == 0:
+                        selected_grade = "高中组"
+                        break
+                    elif choice == 1:
+                        selected_grade = "初中组"
+                        break
+                    elif 2 <= choice < 2 + len(available_grades):
+                        selected_grade = available_grades[choice - 2]
+                        break
+                    else:
+                        print("❌ 无效选项，请重新输入")
+                except ValueError:
+                    print("❌ 请输入有效的数字")
 
         # 筛选符合条件的未发布数据
-        filtered_df = filter_by_grade(df, selected_grade)
-        if len(filtered_df) == 0:
+        filtered = filter_by_grade(rows, selected_grade)
+        if len(filtered) == 0:
             print(f"❌ 没有找到{selected_grade}的未发布数据")
             return
-        print(f"✅ 筛选出{selected_grade}的未发布数据共{len(filtered_df)}条")
+        print(f"✅ 筛选出{selected_grade}的未发布数据共{len(filtered)}条")
 
         # 设置每日发布数量
-        while True:
-            try:
-                daily_quota = int(input("\n请设置每日发布数量 (建议不超过10条): "))
-                if daily_quota > 0 and daily_quota <= len(filtered_df):
-                    break
-                elif daily_quota > len(filtered_df):
-                    print(f"⚠️ 发布数量超过可用数据，已自动调整为{len(filtered_df)}")
-                    daily_quota = len(filtered_df)
-                    break
-                else:
-                    print("❌ 请输入大于0的数字")
-            except ValueError:
-                print("❌ 请输入有效的数字")
+        if count is not None:
+            daily_quota = min(count, len(filtered))
+        else:
+            while True:
+                try:
+                    daily_quota = int(input("\n请设置每日发布数量 (建议不超过10条): "))
+                    if daily_quota > 0 and daily_quota <= len(filtered):
+                        break
+                    elif daily_quota > len(filtered):
+                        print(f"⚠️ 发布数量超过可用数据，已自动调整为{len(filtered)}")
+                        daily_quota = len(filtered)
+                        break
+                    else:
+                        print("❌ 请输入大于0的数字")
+                except ValueError:
+                    print("❌ 请输入有效的数字")
 
         # 打乱顺序，避免固定顺序发布
-        to_publish = filtered_df.sample(frac=1).reset_index(drop=True)
+        # 列表元素与 rows 中是同一行对象，发布后直接原地更新状态
+        to_publish = random.sample(filtered, len(filtered))
         published_count = 0
+        attempts = 0  # 已处理条数（含发布失败）
 
         # 开始发布流程
         print("\n🚀 开始发布流程...")
@@ -316,33 +447,35 @@ def main():
 
         while published_count < daily_quota:
             # 获取当前要发布的记录
-            current_idx = to_publish.index[published_count]
-            current_row = to_publish.iloc[published_count]
+            if count is None:
+                current_row = to_publish[published_count]
+            else:
+                # 单次运行按尝试次数计：每条最多处理一次，失败不在进程内重试，交给下一次定时运行
+                if attempts >= daily_quota:
+                    print(f"\n⚠️ 本次共尝试{attempts}条，成功{published_count}条，其余留待下次运行")
+                    break
+                current_row = to_publish[attempts]
+            attempts += 1
             title = current_row["title"]
             
             print(f"\n📝 正在处理第{published_count + 1}条: {title}")
 
-            # 生成内容
-            print("🔤 正在生成文案...")
-            content = call_qwen_text(title)
+            # 文案、标签、封面图都只依赖标题，并发生成
+            print("🔤 正在生成文案 / 🏷️ 标签 / 🎨 封面图...")
+            text_future = QWEN_POOL.submit(call_qwen_text, title)
+            tags_future = QWEN_POOL.submit(call_qwen_tags, title)
+            image_future = QWEN_POOL.submit(call_qwen_image, title)
+            content = text_future.result()
+            tags = tags_future.result()
+            image_url = image_future.result()
+
             if not content:
                 print("❌ 无法生成文本内容，跳过该条")
                 published_count += 1
                 continue
             print("✅ 文案生成完成")
-
-            time.sleep(random.randint(*SLEEP_RANGE))
-            
-            # 生成标签
-            print("🏷️ 正在生成标签...")
-            tags = call_qwen_tags(title)
             print(f"✅ 生成标签: {tags}")
 
-            time.sleep(random.randint(*SLEEP_RANGE))
-            
-            # 生成图片
-            print("🎨 正在生成封面图...")
-            image_url = call_qwen_image(title)
             if not image_url:
                 print("❌ 无法生成图片，跳过该条")
                 published_count += 1
@@ -356,9 +489,10 @@ def main():
             if success:
                 # 更新发布状态
                 now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                df.loc[df["title"] == title, "已发布"] = "已发布"
-                df.loc[df["title"] == title, "发布时间"] = now
-                save_csv_data(df)
+                current_row["已发布"] = "已发布"
+                current_row["发布时间"] = now
+                # 只追加一行日志，退出时再合并回 CSV
+                append_published_log(title, now)
                 published_count += 1
                 print(f"✅ 第{published_count}条发布成功，时间: {now}")
             else:
@@ -368,7 +502,7 @@ def main():
             show_progress(published_count, daily_quota, daily_quota)
 
             # 如果不是最后一条，计算下一次发布时间
-            if published_count < daily_quota:
+            if count is None and published_count < daily_quota:
                 base_interval = 3600  # 1小时(秒)
                 random_offset = random.randint(300, 900)  # 5-15分钟(秒)
                 next_interval = base_interval + random_offset
@@ -379,12 +513,34 @@ def main():
                 print(f"\n⏰ 下一条将在{hours}小时{minutes}分钟后发布")
                 time.sleep(next_interval)
 
-        print("\n🎉 今日发布任务已完成!")
+        print("\n🎉 今日发布任务已完成!" if count is None else "\n🎉 本次运行已结束!")
 
     except Exception as e:
         logging.error(f"❌ 程序运行出错: {e}")
         print(f"❌ 程序出错: {e}")
+    finally:
+        # 直接保存已加载的数据，不在这里重新读取 CSV；合并失败只记录日志
+        # （发布状态日志保留，下次运行重新合并），不掩盖上面的原始异常
+        try:
+            merge_published_log(rows)
+        except Exception as e:
+            logging.error(f"❌ 合并发布状态日志失败: {e}")
+
+
+def positive_int(value: str) -> int:
+    """argparse 参数类型：正整数"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"必须是正整数: {value}")
+    return number
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="生成并发布教育资料笔记到小红书 MCP")
+    parser.add_argument("--grade", help="发布范围：高中组 / 初中组 / 具体年级（不填则交互选择）")
+    parser.add_argument("--count", type=positive_int,
+                        help="非交互单次运行：发布 N 条后立即退出，发布间隔交给 systemd timer / cron 调度")
+    args = parser.parse_args()
+    if args.count is not None and not args.grade:
+        parser.error("--count 为非交互运行，需同时指定 --grade")
+    main(args.grade, args.count)
\ No newline at end of file